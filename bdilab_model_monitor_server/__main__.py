@@ -1,7 +1,7 @@
 import argparse
 from bdilab_model_monitor_server.server import CEServer
 from bdilab_model_monitor_server.protocols import Protocol
-from bdilab_model_monitor_server.constants import DEFAULT_HTTP_PORT, DEFAULT_MODEL_NAME
+from bdilab_model_monitor_server.constants import DEFAULT_HTTP_PORT, DEFAULT_MODEL_NAME, DEFAULT_WORKERS
 from enum import Enum
 from bdilab_model_monitor_server.cm_model import CustomMetricsModel
 
@@ -21,6 +21,12 @@ parser.add_argument(
     type=int,
     help="The HTTP Port listened to by the model server.",
 )
+parser.add_argument(
+    "--workers",
+    default=DEFAULT_WORKERS,
+    type=int,
+    help="The number of server processes, 0 starts one per CPU core.",
+)
 parser.add_argument(
     "--protocol",
     type=Protocol,
@@ -56,4 +62,5 @@ if __name__ == "__main__":
         args.event_source,
         http_port=args.http_port,
         reply_url=args.reply_url,
+        workers=args.workers,
     ).start(model)
@@ -45,3 +45,24 @@ class CEModel(object):
 
         """
         raise NotImplementedError
+
+    def process_event_batch(
+        self, inputs: List[Dict], headers: List[Dict]
+    ) -> List[Optional[ModelResponse]]:
+        """
+        Process a batch of events and return one response per event.
+        Models can override this to amortize work across events.
+
+        Parameters
+        ----------
+        inputs
+             Input data of each event
+        headers
+             Headers of each event
+
+        Returns
+        -------
+             A list of response objects in the same order as the events
+
+        """
+        return [self.process_event(i, h) for i, h in zip(inputs, headers)]
@@ -55,6 +55,21 @@ def _append_model_monitor_metrcs(metrics, model_monitor, name):
             )
 
 
+def _select(scores, index):
+    # 从 precision_recall_fscore_support 的结果中取出单项指标
+    return None if scores is None else scores[index]
+
+
+def _uniform_average(raw_values):
+    # 与 sklearn 的 multioutput='uniform_average' 一致：对各输出的结果取平均
+    return None if raw_values is None else np.average(raw_values)
+
+
+def _root(raw_values):
+    # 与 sklearn 的 squared=False 一致：先对各输出开方，再做平均
+    return None if raw_values is None else np.sqrt(raw_values)
+
+
 class CustomMetricsModel(CEModel):
     def __init__(self, name: str):
         super().__init__(name)
@@ -74,20 +89,26 @@ class CustomMetricsModel(CEModel):
             output["data"]["multilabel_confusion_matrix"] = self.get_multilabel_confusion_matrix(self, y_true=y_true, y_pred=y_pred)
             output["data"]["accuracy_score"] = self.get_accuracy_score(self, y_true=y_true, y_pred=y_pred)
 
-            output["data"]["precision_score_each"] = self.get_precision_score(self, y_true=y_true, y_pred=y_pred, average=None)
-            output["data"]["precision_score_micro"] = self.get_precision_score(self, y_true=y_true, y_pred=y_pred, average=Average.micro.value)
-            output["data"]["precision_score_macro"] = self.get_precision_score(self, y_true=y_true, y_pred=y_pred, average=Average.macro.value)
-            output["data"]["precision_score_weighted"] = self.get_precision_score(self, y_true=y_true, y_pred=y_pred, average=Average.weighted.value)
+            # precision、recall、f1 由同一次统计得到，每种 average 只计算一次
+            prf_each = self.get_precision_recall_fscore_support(self, y_true=y_true, y_pred=y_pred, average=None)
+            prf_micro = self.get_precision_recall_fscore_support(self, y_true=y_true, y_pred=y_pred, average=Average.micro.value)
+            prf_macro = self.get_precision_recall_fscore_support(self, y_true=y_true, y_pred=y_pred, average=Average.macro.value)
+            prf_weighted = self.get_precision_recall_fscore_support(self, y_true=y_true, y_pred=y_pred, average=Average.weighted.value)
 
-            output["data"]["recall_score_each"] = self.get_recall_score(self, y_true=y_true, y_pred=y_pred, average=None)
-            output["data"]["recall_score_micro"] = self.get_recall_score(self, y_true=y_true, y_pred=y_pred, average=Average.micro.value)
-            output["data"]["recall_score_macro"] = self.get_recall_score(self, y_true=y_true, y_pred=y_pred, average=Average.macro.value)
-            output["data"]["recall_score_weighted"] = self.get_recall_score(self, y_true=y_true, y_pred=y_pred, average=Average.weighted.value)
+            output["data"]["precision_score_each"] = _select(prf_each, 0)
+            output["data"]["precision_score_micro"] = _select(prf_micro, 0)
+            output["data"]["precision_score_macro"] = _select(prf_macro, 0)
+            output["data"]["precision_score_weighted"] = _select(prf_weighted, 0)
 
-            output["data"]["f1_score_each"] = self.get_f1_score(self, y_true=y_true, y_pred=y_pred, average=None)
-            output["data"]["f1_score_micro"] = self.get_f1_score(self, y_true=y_true, y_pred=y_pred, average=Average.micro.value)
-            output["data"]["f1_score_macro"] = self.get_f1_score(self, y_true=y_true, y_pred=y_pred, average=Average.macro.value)
-            output["data"]["f1_score_weighted"] = self.get_f1_score(self, y_true=y_true, y_pred=y_pred, average=Average.weighted.value)
+            output["data"]["recall_score_each"] = _select(prf_each, 1)
+            output["data"]["recall_score_micro"] = _select(prf_micro, 1)
+            output["data"]["recall_score_macro"] = _select(prf_macro, 1)
+            output["data"]["recall_score_weighted"] = _select(prf_weighted, 1)
+
+            output["data"]["f1_score_each"] = _select(prf_each, 2)
+            output["data"]["f1_score_micro"] = _select(prf_micro, 2)
+            output["data"]["f1_score_macro"] = _select(prf_macro, 2)
+            output["data"]["f1_score_weighted"] = _select(prf_weighted, 2)
 
             output["data"]["roc_auc_score_each"] = self.get_roc_auc_score(self, y_true=y_true, y_pred=y_pred, average=None)
             output["data"]["roc_auc_score_micro"] = self.get_roc_auc_score(self, y_true=y_true, y_pred=y_pred, average=Average.micro.value)
@@ -106,15 +127,18 @@ class CustomMetricsModel(CEModel):
             output["data"]["mean_absolute_error_uniform_average"] = self.get_mean_absolute_error(self, y_true=y_true, y_pred=y_pred, multioutput=Multioutput.uniform_average.value)
             output["data"]["mean_absolute_error_raw_values"] = self.get_mean_absolute_error(self, y_true=y_true, y_pred=y_pred, multioutput=Multioutput.raw_values.value)
 
-            output["data"]["mean_squared_error_uniform_average"] = self.get_mean_squared_error(self, y_true=y_true, y_pred=y_pred, multioutput=Multioutput.uniform_average.value, squared=True)
-            output["data"]["mean_squared_error_raw_values"] = self.get_mean_squared_error(self, y_true=y_true, y_pred=y_pred, multioutput=Multioutput.raw_values.value, squared=True)
-            output["data"]["root_mean_squared_error_uniform_average"] = self.get_mean_squared_error(self, y_true=y_true, y_pred=y_pred, multioutput=Multioutput.uniform_average.value, squared=False)
-            output["data"]["root_mean_squared_error_raw_values"] = self.get_mean_squared_error(self, y_true=y_true, y_pred=y_pred, multioutput=Multioutput.raw_values.value, squared=False)
+            # 只计算一次 raw_values，其余结果由其推导
+            mse_raw = self.get_mean_squared_error(self, y_true=y_true, y_pred=y_pred, multioutput=Multioutput.raw_values.value, squared=True)
+            output["data"]["mean_squared_error_uniform_average"] = _uniform_average(mse_raw)
+            output["data"]["mean_squared_error_raw_values"] = mse_raw
+            output["data"]["root_mean_squared_error_uniform_average"] = _uniform_average(_root(mse_raw))
+            output["data"]["root_mean_squared_error_raw_values"] = _root(mse_raw)
 
-            output["data"]["mean_squared_log_error_uniform_average"] = self.get_mean_squared_log_error(self, y_true=y_true, y_pred=y_pred, multioutput=Multioutput.uniform_average.value, squared=True)
-            output["data"]["mean_squared_log_error_raw_values"] = self.get_mean_squared_log_error(self, y_true=y_true, y_pred=y_pred, multioutput=Multioutput.raw_values.value, squared=True)
-            output["data"]["root_mean_squared_log_error_uniform_average"] = self.get_mean_squared_log_error(self, y_true=y_true, y_pred=y_pred, multioutput=Multioutput.uniform_average.value, squared=False)
-            output["data"]["root_mean_squared_log_error_raw_values"] = self.get_mean_squared_log_error(self, y_true=y_true, y_pred=y_pred, multioutput=Multioutput.raw_values.value, squared=False)
+            msle_raw = self.get_mean_squared_log_error(self, y_true=y_true, y_pred=y_pred, multioutput=Multioutput.raw_values.value, squared=True)
+            output["data"]["mean_squared_log_error_uniform_average"] = _uniform_average(msle_raw)
+            output["data"]["mean_squared_log_error_raw_values"] = msle_raw
+            output["data"]["root_mean_squared_log_error_uniform_average"] = _uniform_average(_root(msle_raw))
+            output["data"]["root_mean_squared_log_error_raw_values"] = _root(msle_raw)
 
             output["data"]["median_absolute_error_uniform_average"] = self.get_median_absolute_error(self, y_true=y_true, y_pred=y_pred, multioutput=Multioutput.uniform_average.value)
             output["data"]["median_absolute_error_raw_values"] = self.get_median_absolute_error(self, y_true=y_true, y_pred=y_pred, multioutput=Multioutput.raw_values.value)
@@ -288,13 +312,11 @@ class CustomMetricsModel(CEModel):
         return brier_score_loss
 
     @staticmethod
-    def get_precision_recall_fscore_support(self, y_true: Union[List], y_pred: Union[List]):
+    def get_precision_recall_fscore_support(self, y_true: Union[List], y_pred: Union[List], average: Any = None):
         try:
-            precision_recall_fscore_support = metrics.precision_recall_fscore_support(y_true, y_pred)
+            return metrics.precision_recall_fscore_support(y_true, y_pred, average=average, zero_division=0)
         except Exception as e:
-            print("Oops! An error occurred:", e)
             return None
-        return precision_recall_fscore_support
 
     # 回归任务指标
     @staticmethod
@@ -1,2 +1,3 @@
 DEFAULT_HTTP_PORT = 8080
+DEFAULT_WORKERS = 0
 DEFAULT_MODEL_NAME = "monitor_model"
@@ -29,6 +29,7 @@ FEEDBACK_REWARD_KEY = "bdilab_api_model_feedback_reward"
 COUNTER = "COUNTER"
 GAUGE = "GAUGE"
 TIMER = "TIMER"
+METRIC_TYPES = (COUNTER, GAUGE, TIMER)
 
 # This sets the bins spread logarithmically between 0.001 and 30
 BINS = [0] + list(np.logspace(-3, np.log10(30), 50)) + [np.inf]
@@ -83,13 +84,17 @@ HEALTH_METRIC_METHOD_TAG = "health"
 class BdilabMetrics:
     """Class to manage custom prometheus_metrics stored in shared memory."""
 
-    def __init__(self, worker_id_func=os.getpid, extra_default_labels={}):
+    def __init__(self, worker_id_func=os.getpid, extra_default_labels={}, cache_worker_data=False):
         # We keep reference to Manager so it does not get garbage collected
         self._manager = Manager()   # self._manager：一个 multiprocessing.Manager 对象，用于管理共享内存。这个引用确保 Manager 对象不会被垃圾回收。
         self._lock = self._manager.Lock()   # self._lock：一个由 Manager 创建的锁对象，用于确保对共享数据的访问是线程安全的。
         self.data = self._manager.dict()    # self.data：一个由 Manager 创建的字典对象，用于存储共享数据。这个字典将包含每个工作进程的度量数据。
         self.worker_id_func = worker_id_func    # self.worker_id_func：一个函数，用于获取当前工作进程的 ID。这个函数将在后续的度量更新中使用。
         self._extra_default_labels = extra_default_labels   # self._extra_default_labels：一个包含额外默认标签的字典，这些标签将添加到所有度量指标中。
+        # Each worker is the only writer of its own entry in self.data, so with cache_worker_data
+        # a local copy replaces reading the entry back from shared memory on every update
+        self._cache_worker_data = cache_worker_data
+        self._local_data = {}
 
     def __del__(self):
         self._manager.shutdown()
@@ -112,9 +117,15 @@ class BdilabMetrics:
         # are not thread-safe, see "Thread safety of proxies" here
         # https://docs.python.org/3.7/library/multiprocessing.html#programming-guidelines
         logger.debug("Updating prometheus_metrics: {}".format(custom_metrics))
-        with self._lock:
-            worker_data = self.data.get(self.worker_id_func(), {})
-        logger.debug("Read current prometheus_metrics data from shared memory")
+        worker_id = self.worker_id_func()
+        if self._cache_worker_data and worker_id in self._local_data:
+            # Entries are replaced rather than mutated, so a shallow copy keeps the
+            # cache untouched if this update fails part way
+            worker_data = dict(self._local_data[worker_id])
+        else:
+            with self._lock:
+                worker_data = self.data.get(worker_id, {})
+            logger.debug("Read current prometheus_metrics data from shared memory")
 
         for metrics in custom_metrics:
             metrics_type = metrics.get("type", "COUNTER")
@@ -141,7 +152,9 @@ class BdilabMetrics:
 
         # Write worker's data with lock (again - Proxy objects are not thread-safe)
         with self._lock:
-            self.data[self.worker_id_func()] = worker_data
+            self.data[worker_id] = worker_data
+        if self._cache_worker_data:
+            self._local_data[worker_id] = worker_data
         logger.debug("Updated prometheus_metrics in the shared memory.")
 
     def collect(self):
@@ -178,12 +191,26 @@ class BdilabMetrics:
             exposition.CONTENT_TYPE_LATEST,
         )
 
+    def generate_metrics_iter(self):
+        """
+        Like `generate_metrics`, but yields the exposition one metric family at a
+        time so the whole output is never held in memory.
+        """
+        return (
+            (
+                exposition.generate_latest(_MetricFamilies([metric]))
+                for metric in self.collect()
+            ),
+            exposition.CONTENT_TYPE_LATEST,
+        )
+
     def clear(self):
         """
         Clear all prometheus_metrics from current worker.
         """
         worker_id = self.worker_id_func()
         logger.debug(f"Clearing prometheus_metrics from worker #{worker_id}")
+        self._local_data.pop(worker_id, None)
         with self._lock:
             if worker_id in self.data:
                 del self.data[worker_id]
@@ -229,6 +256,16 @@ class BdilabMetrics:
         return metric
 
 
+class _MetricFamilies:
+    """Minimal registry exposing a fixed list of metric families."""
+
+    def __init__(self, families):
+        self._families = families
+
+    def collect(self):
+        return self._families
+
+
 def create_counter(key: str, value: float):
     """
     Utility method to create a counter metric
@@ -294,11 +331,7 @@ def validate_metrics(metrics: List[Dict]) -> bool:
         for metric in metrics:
             if not ("key" in metric and "value" in metric and "type" in metric):
                 return False
-            if not (
-                metric["type"] == COUNTER
-                or metric["type"] == GAUGE
-                or metric["type"] == TIMER
-            ):
+            if metric["type"] not in METRIC_TYPES:
                 return False
             try:
                 metric["value"] + 1
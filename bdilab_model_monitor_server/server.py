@@ -1,14 +1,20 @@
-import json
+import asyncio
+import io
 import logging
 import os
 from http import HTTPStatus
-from typing import Dict, Optional
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
 
-import requests
+import msgpack
+import orjson
+import tornado.httpclient
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
 from bdilab_model_monitor_server.base import CEModel, ModelResponse
+from bdilab_model_monitor_server.cm_model import TaskType
 from bdilab_model_monitor_server.protocols.request_handler import RequestHandler
 from bdilab_model_monitor_server.protocols.common_http import CommonRequestHandler
 from cloudevents.sdk import converters
@@ -21,8 +27,52 @@ import numpy as np
 from datetime import datetime, timezone
 
 DEFAULT_HTTP_PORT = 8080
+DEFAULT_WORKERS = 0
 CESERVER_LOGLEVEL = os.environ.get("CESERVER_LOGLEVEL", "INFO").upper()
 logging.basicConfig(level=CESERVER_LOGLEVEL)
+logger = logging.getLogger(__name__)
+
+# Maximum number of concurrent outbound reply requests and their timeouts in seconds
+REPLY_MAX_CLIENTS = int(os.environ.get("REPLY_MAX_CLIENTS", "100"))
+REPLY_CONNECT_TIMEOUT = float(os.environ.get("REPLY_CONNECT_TIMEOUT", "1"))
+REPLY_REQUEST_TIMEOUT = float(os.environ.get("REPLY_REQUEST_TIMEOUT", "5"))
+
+
+# Events are grouped into batches of at most MAX_BATCH_SIZE, waiting no more
+# than BATCH_TIMEOUT_MS for a batch to fill up
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "32"))
+BATCH_TIMEOUT_MS = float(os.environ.get("BATCH_TIMEOUT_MS", "5"))
+
+# The metrics exposition is streamed, flushing whenever this many bytes are buffered
+METRICS_FLUSH_BYTES = 64 * 1024
+
+# Inbound events are built from their binary-mode ce- headers unless the full
+# CloudEvents marshaller is enabled, e.g. for structured-mode events
+CLOUDEVENTS_MARSHALLER = (
+    os.environ.get("CESERVER_CLOUDEVENTS_MARSHALLER", "false").lower() == "true"
+)
+# ce- headers of the CloudEvents v1 context attributes, all others are extensions
+CE_ATTRIBUTE_HEADERS = frozenset(
+    "ce-" + attribute
+    for attribute in (
+        "specversion", "id", "source", "type",
+        "datacontenttype", "dataschema", "subject", "time",
+    )
+)
+
+# The CloudEvents converters hold no per-event state, so one marshaller is shared by all requests
+_HTTP_MARSHALLER = marshaller.NewDefaultHTTPMarshaller()
+
+# Binary request bodies accepted next to JSON. Both carry the same keys as the
+# JSON body, npz archives holding one named array per key
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+NPZ_CONTENT_TYPE = "application/x-npz"
+
+# NumPy dtype of y_true/y_pred per task type. Classification labels may be strings
+# or scores, so their dtype is left to NumPy to infer
+TASK_DTYPES = {
+    TaskType.regression.value: np.float64,
+}
 
 DEFAULT_LABELS = {
     "deployment_namespace": os.environ.get(
@@ -39,6 +89,7 @@ class CEServer(object):
         event_source: str,
         http_port: int = DEFAULT_HTTP_PORT,
         reply_url: str = None,
+        workers: int = DEFAULT_WORKERS,
     ):
         """
         CloudEvents server
@@ -49,31 +100,37 @@ class CEServer(object):
              wire protocol
         http_port
              http port to listen on
+        workers
+             number of server processes, 0 starts one per CPU core
         """
         self.registered_model: Optional[CEModel] = None
         self.http_port = http_port
+        self.workers = workers
         self.protocol = protocol
         self.reply_url = reply_url
         self._http_server: Optional[tornado.httpserver.HTTPServer] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._extract = _build_extractor(protocol)
         self.event_type = event_type
         self.event_source = event_source
         self.bdilab_metrics = BdilabMetrics(
-            extra_default_labels=DEFAULT_LABELS
+            extra_default_labels=DEFAULT_LABELS, cache_worker_data=True
         )
 
     def create_application(self):
+        self._queue = asyncio.Queue()
+        tornado.ioloop.IOLoop.current().spawn_callback(self._batch_worker)
         return tornado.web.Application(
             [
                 (
                     r"/",
                     EventHandler,
                     dict(
-                        protocol=self.protocol,
-                        model=self.registered_model,
+                        extract=self._extract,
+                        queue=self._queue,
                         reply_url=self.reply_url,
                         event_type=self.event_type,
                         event_source=self.event_source,
-                        bdilab_metrics=self.bdilab_metrics
                     ),
                 ),
                 (r"/protocol", ProtocolHandler, dict(protocol=self.protocol)),
@@ -94,12 +151,27 @@ class CEServer(object):
         """
         self.register_model(model)
 
+        # The curl client keeps connections to reply_url alive. AsyncHTTPClient
+        # instances are shared per IOLoop, so configure rather than construct it
+        tornado.httpclient.AsyncHTTPClient.configure(
+            "tornado.curl_httpclient.CurlAsyncHTTPClient",
+            max_clients=REPLY_MAX_CLIENTS,
+            defaults=dict(
+                connect_timeout=REPLY_CONNECT_TIMEOUT,
+                request_timeout=REPLY_REQUEST_TIMEOUT,
+            ),
+        )
+
+        logger.info("Listening on port %s" % self.http_port)
+        sockets = tornado.netutil.bind_sockets(self.http_port)
+        # Workers share the listening sockets and, through BdilabMetrics'
+        # Manager, the prometheus_metrics of every worker
+        if self.workers != 1:
+            tornado.process.fork_processes(self.workers)
+
         self._http_server = tornado.httpserver.HTTPServer(
             self.create_application())
-
-        logging.info("Listening on port %s" % self.http_port)
-        self._http_server.bind(self.http_port)
-        self._http_server.start(1)  # Single worker at present
+        self._http_server.add_sockets(sockets)
         tornado.ioloop.IOLoop.current().start()
 
     def register_model(self, model: CEModel):
@@ -107,7 +179,197 @@ class CEServer(object):
             raise Exception(
                 "Failed to register model, model.name must be provided.")
         self.registered_model = model
-        logging.info("Registering model:" + model.name)
+        logger.info("Registering model:" + model.name)
+
+    async def _batch_worker(self):
+        """
+        Drain queued events in batches and resolve their futures with
+        the model response and reply event time
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + BATCH_TIMEOUT_MS / 1000
+            while len(batch) < MAX_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                self._process_batch(batch)
+            except Exception as e:
+                # Keep the worker alive and fail the events still waiting on this batch
+                logger.exception("Failed to process a batch of %d events", len(batch))
+                for _, _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+    def _process_batch(self, batch: List[Tuple[Dict, Dict, asyncio.Future]]):
+        inputs, headers, futures = (list(x) for x in zip(*batch))
+        # Replies of one batch share a single RFC 3339 timestamp
+        event_time = datetime.now(timezone.utc).isoformat()
+        try:
+            responses = self.registered_model.process_event_batch(inputs, headers)
+        except Exception:
+            # Fall back to single events so one bad event does not fail the whole batch
+            responses = []
+            for event_inputs, event_headers, fut in batch:
+                try:
+                    responses.append(
+                        self.registered_model.process_event(event_inputs, event_headers)
+                    )
+                except Exception as e:
+                    responses.append(None)
+                    if not fut.done():
+                        fut.set_exception(e)
+        if len(responses) != len(batch):
+            raise Exception(
+                "Model returned %d responses for a batch of %d events"
+                % (len(responses), len(batch))
+            )
+
+        # Push the metrics of the whole batch to shared memory in a single update
+        event_metrics = []
+        for response, fut in zip(responses, futures):
+            if fut.done() or response is None or response.metrics is None:
+                continue
+            try:
+                valid = validate_metrics(response.metrics)
+            except Exception as e:
+                fut.set_exception(e)
+                continue
+            if valid:
+                event_metrics.append((response.metrics, fut))
+            else:
+                logger.error("Metrics returned are invalid: " + str(response.metrics))
+        if event_metrics:
+            try:
+                self.bdilab_metrics.update(
+                    [metric for metrics, _ in event_metrics for metric in metrics],
+                    self.event_type,
+                )
+            except Exception:
+                # A failed update records nothing, so retry per event to fail only the bad ones
+                for metrics, fut in event_metrics:
+                    try:
+                        self.bdilab_metrics.update(metrics, self.event_type)
+                    except Exception as e:
+                        fut.set_exception(e)
+
+        for fut, response in zip(futures, responses):
+            if not fut.done():
+                fut.set_result((response, event_time))
+
+
+def _json_dumps(obj) -> bytes:
+    """
+    Serialize to JSON bytes, including any NumPy arrays and scalars
+    """
+    return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def _serialize_data(data) -> bytes:
+    """
+    Serialize response data to JSON bytes, passing through bytes-like data
+    that the model has already serialized
+    """
+    if isinstance(data, bytes):
+        return data
+    if isinstance(data, (bytearray, memoryview)):
+        return bytes(data)
+    return _json_dumps(data)
+
+
+def parse_request_body(content_type: Optional[str], raw_body: bytes) -> Dict:
+    """
+    Parse the request body according to its content type
+
+    Parameters
+    ----------
+    content_type
+         Content-Type header of the request
+    raw_body
+         The raw request body
+    Returns
+    -------
+         The request as a dict, NumPy arrays for npz bodies
+
+    """
+    mimetype = (content_type or "").split(";")[0].strip().lower()
+    if mimetype == MSGPACK_CONTENT_TYPE:
+        return msgpack.unpackb(raw_body, raw=False)
+    elif mimetype == NPZ_CONTENT_TYPE:
+        request = {}
+        with np.load(io.BytesIO(raw_body), allow_pickle=False) as npz:
+            for key in npz.files:
+                value = npz[key]
+                # 0-d arrays such as task_type are unwrapped to Python scalars
+                request[key] = value.item() if value.ndim == 0 else value
+        return request
+    return orjson.loads(raw_body)
+
+
+def _build_extractor(protocol) -> Callable[[Dict], Tuple[Any, Any, Any]]:
+    """
+    Build the payload extractor of a protocol once, rather than creating and
+    validating a request handler per request
+
+    Parameters
+    ----------
+    protocol
+         Protocol to use
+    Returns
+    -------
+         A function returning (y_pred, y_true, task_type) from a request body
+
+    """
+    if protocol == Protocol.common_http:
+        def extract(request: Dict) -> Tuple[Any, Any, Any]:
+            try:
+                return request["predictions"], request["truth"], request["task_type"]
+            except KeyError as e:
+                raise tornado.web.HTTPError(
+                    status_code=HTTPStatus.BAD_REQUEST,
+                    reason="Expected key %s in request body" % e,
+                )
+            except TypeError:
+                raise tornado.web.HTTPError(
+                    status_code=HTTPStatus.BAD_REQUEST,
+                    reason="Expected an object as request body",
+                )
+
+        return extract
+    else:
+        raise Exception(f"Unknown protocol {protocol}")
+
+
+def event_from_headers(headers: Mapping[str, str]) -> v1.Event:
+    """
+    Build the CloudEvent of a binary-mode request from its headers. Only the
+    event id and extensions are set, which is all the replies need.
+
+    Parameters
+    ----------
+    headers
+         Headers of the request
+    Returns
+    -------
+         The CloudEvent of the request
+
+    """
+    extensions = {}
+    for key, value in headers.items():
+        key = key.lower()
+        if key.startswith("ce-") and key not in CE_ATTRIBUTE_HEADERS:
+            extensions[key[3:]] = value
+    return (
+        v1.Event()
+            .SetEventID(headers.get("ce-id", ""))
+            .SetExtensions(extensions)
+    )
 
 
 def get_request_handler(protocol, request: Dict) -> RequestHandler:
@@ -131,7 +393,7 @@ def get_request_handler(protocol, request: Dict) -> RequestHandler:
         raise Exception(f"Unknown protocol {protocol}")
 
 
-def sendCloudEvent(event: v1.Event, url: str):
+async def sendCloudEvent(event: v1.Event, url: str):
     """
     Send CloudEvent
 
@@ -143,107 +405,117 @@ def sendCloudEvent(event: v1.Event, url: str):
          Url to send event
 
     """
-    http_marshaller = marshaller.NewDefaultHTTPMarshaller()
-    binary_headers, binary_data = http_marshaller.ToRequest(
-        event, converters.TypeBinary, json.dumps
+    binary_headers, binary_data = _HTTP_MARSHALLER.ToRequest(
+        event, converters.TypeBinary, _serialize_data
     )
 
-    logging.info("binary CloudEvent")
-    for k, v in binary_headers.items():
-        logging.info("{0}: {1}\r\n".format(k, v))
-    logging.info(binary_data)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("CloudEvent headers: %s body=%s", binary_headers, binary_data)
 
-    response = requests.post(url, headers=binary_headers, data=binary_data)
-    response.raise_for_status()
+    request = tornado.httpclient.HTTPRequest(
+        url, method="POST", headers=binary_headers, body=binary_data
+    )
+    await tornado.httpclient.AsyncHTTPClient().fetch(request, raise_error=True)
 
 
 class EventHandler(tornado.web.RequestHandler):
     def initialize(
         self,
-        protocol: str,
-        model: CEModel,
+        extract: Callable[[Dict], Tuple[Any, Any, Any]],
+        queue: asyncio.Queue,
         reply_url: str,
         event_type: str,
         event_source: str,
-        bdilab_metrics: BdilabMetrics
     ):
-        self.protocol = protocol
-        self.model = model
+        self.extract = extract
+        self.queue = queue
         self.reply_url = reply_url
         self.event_type = event_type
         self.event_source = event_source
-        self.bdilab_metrics = bdilab_metrics
 
-    def post(self):
+    async def post(self):
         """
         Handle post request. Extract data. 
         """
         try:
-            body = json.loads(self.request.body)
-        except json.decoder.JSONDecodeError as e:
+            body = parse_request_body(
+                self.request.headers.get("Content-Type"), self.request.body
+            )
+        except Exception as e:
             raise tornado.web.HTTPError(
                 status_code=HTTPStatus.BAD_REQUEST,
                 reason="Unrecognized request format: %s" % e,
             )
 
         # Extract payload from request
-        request_handler: RequestHandler = get_request_handler(
-            self.protocol, body)
-        request_handler.validate()
-        # y_pred, y_true, task_type, metrics_type = request_handler.extract_request()
-        y_pred, y_true, task_type = request_handler.extract_request()
-
-        # Create event from request body
-        event = v1.Event()
-        http_marshaller = marshaller.NewDefaultHTTPMarshaller()
-        event = http_marshaller.FromRequest(
-            event, self.request.headers, self.request.body, json.loads
-        )
-        logging.debug(json.dumps(event.Properties()))
+        y_pred, y_true, task_type = self.extract(body)
+
+        if CLOUDEVENTS_MARSHALLER:
+            # Create event from request body. Binary events hand back the raw body
+            # as their data, which has already been parsed above
+            raw_body = self.request.body
+            event = v1.Event()
+            event = _HTTP_MARSHALLER.FromRequest(
+                event,
+                self.request.headers,
+                raw_body,
+                lambda data: body if data is raw_body else orjson.loads(data),
+            )
+            # Replies only need the id and extensions, not the request payload
+            event.SetData(None)
+            raw_body = None
+        else:
+            event = event_from_headers(self.request.headers)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("props: %s", event.Properties())
 
         # Extract any desired request headers
-        headers = {}
-
-        for (key, val) in self.request.headers.get_all():
-            headers[key] = val
+        headers = dict(self.request.headers)
         headers["task_type"] = task_type
 
         inputs = {}
         try:
-            inputs["y_true"] = np.array(y_true)
-            inputs["y_pred"] = np.array(y_pred)
+            dtype = TASK_DTYPES.get(task_type)
+            inputs["y_true"] = np.asarray(y_true, dtype=dtype)
+            inputs["y_pred"] = np.asarray(y_pred, dtype=dtype)
         except Exception as e:
             raise Exception(
                 "Failed to initialize NumPy array from inputs: %s, %s" % (e, inputs)
             )
-        response: Optional[ModelResponse] = self.model.process_event(inputs, headers)
+        # Release the request payload before waiting on the model and the reply
+        self.request.body = b""
+        body = y_true = y_pred = None
+
+        # Hand the event to the batch worker, which also records the runtime metrics
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((inputs, headers, fut))
+        response: Optional[ModelResponse]
+        response, event_time = await fut
 
-        runtime_metrics = response.metrics
-        if runtime_metrics is not None:
-            if validate_metrics(runtime_metrics):
-                self.bdilab_metrics.update(runtime_metrics, self.event_type)
-            else:
-                logging.error("Metrics returned are invalid: " + str(runtime_metrics))
         if response.data is not None:
+            # Serialize once for both the reply event and the response
+            data = _serialize_data(response.data)
             # Create event from response if reply_url is active
             if not self.reply_url == "":
                 if event.EventID() is None or event.EventID() == "":
-                    resp_event_id = uuid.uuid1().hex
+                    resp_event_id = uuid.uuid4().hex
                 else:
                     resp_event_id = event.EventID()
                 revent = (
                     v1.Event()
                         .SetContentType("application/json")
-                        .SetData(response.data)
+                        .SetData(data)
                         .SetEventID(resp_event_id)
                         .SetSource(self.event_source)
                         .SetEventType(self.event_type)
-                        .SetEventTime(datetime.now(timezone.utc).isoformat())   # 符合RFC 3339的时间戳
+                        .SetEventTime(event_time)
                         .SetExtensions(event.Extensions())
                 )
-                logging.debug(json.dumps(revent.Properties()))
-                sendCloudEvent(revent, self.reply_url)
-            self.write(json.dumps(response.data))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("reply props: %s", revent.Properties())
+                await sendCloudEvent(revent, self.reply_url)
+            self.set_header("Content-Type", "application/json")
+            self.write(data)
 
 
 class LivenessHandler(tornado.web.RequestHandler):
@@ -262,7 +534,13 @@ class MetricsHandler(tornado.web.RequestHandler):
     def initialize(self, bdilab_metrics: BdilabMetrics):
         self.bdilab_metrics = bdilab_metrics
 
-    def get(self):
-        metrics, mimetype = self.bdilab_metrics.generate_metrics()
+    async def get(self):
+        chunks, mimetype = self.bdilab_metrics.generate_metrics_iter()
         self.set_header("Content-Type", mimetype)
-        self.write(metrics)
+        buffered = 0
+        for chunk in chunks:
+            self.write(chunk)
+            buffered += len(chunk)
+            if buffered >= METRICS_FLUSH_BYTES:
+                await self.flush()
+                buffered = 0